@@ -1,49 +1,207 @@
 import os
+import re
 import configparser
-import datetime as dt
 from itertools import chain
+import pyspark
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, udf, create_map, lit, monotonically_increasing_id
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, DoubleType
+from pyspark.sql.functions import col, create_map, lit, date_add, lower, year, month, monotonically_increasing_id
 
 config = configparser.ConfigParser()
 config.read('config.cfg')
 
 os.environ["PYSPARK_PYTHON"] = "python"
-os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
 
 SOURCE_S3_BUCKET = config['S3']['SOURCE_S3_BUCKET']
 DEST_S3_BUCKET = config['S3']['DEST_S3_BUCKET']
+STAGING_S3_BUCKET = config['S3']['STAGING_S3_BUCKET']
 
+# Join strategy hint for the immigration_fact dimension joins; SHUFFLE_HASH once the dimensions are too big to broadcast
+DIM_JOIN_HINTS = {"BROADCAST", "SHUFFLE_HASH"}
+DIM_JOIN_HINT = config.get('ETL', 'DIM_JOIN_HINT', fallback="BROADCAST").upper()
+
+
+def spark_runtime_versions():
+    """
+    Reads the Spark, Scala and Hadoop versions bundled with the Spark distribution from its jar file names,
+    so that the S3 packages resolved below match the classes Spark actually loads. Vendor suffixes such as
+    "-amzn-0" are ignored; a version is None when its jar is not present (e.g. "Hadoop-free" Spark builds).
+    :return: Spark version (e.g. "3.3.2"), Scala binary version (e.g. "2.13") and Hadoop version (e.g. "3.3.4")
+    """
+    jars_dir = os.path.join(os.environ.get("SPARK_HOME", os.path.dirname(pyspark.__file__)), "jars")
+    jars = os.listdir(jars_dir) if os.path.isdir(jars_dir) else []
+
+    def jar_match(pattern):
+        return next((m for m in map(re.compile(pattern).match, jars) if m), None)
+
+    spark_core = jar_match(r"spark-core_(\d+\.\d+)-(\d+\.\d+\.\d+)")
+    hadoop_client = jar_match(r"hadoop-(?:client-api|common)-(\d+\.\d+\.\d+)")
+    spark_version, scala_version = (spark_core.group(2), spark_core.group(1)) if spark_core else (None, None)
+    hadoop_version = hadoop_client.group(1) if hadoop_client else None
+    return spark_version, scala_version, hadoop_version
+
+
+SPARK_VERSION, SCALA_VERSION, HADOOP_VERSION = spark_runtime_versions()
+
+# JARS_PACKAGES in config.cfg overrides the detected coordinates, e.g. for Hadoop-free or vendor Spark builds
+JARS_PACKAGES = config.get('SPARK', 'JARS_PACKAGES', fallback="")
+if not JARS_PACKAGES:
+    if None in (SPARK_VERSION, SCALA_VERSION, HADOOP_VERSION):
+        raise RuntimeError("Could not detect the Spark, Scala and Hadoop versions from the jars in the Spark "
+                           "distribution; set JARS_PACKAGES under [SPARK] in config.cfg to the hadoop-aws and "
+                           "spark-hadoop-cloud coordinates matching your cluster")
+    JARS_PACKAGES = f"org.apache.hadoop:hadoop-aws:{HADOOP_VERSION}," \
+                    f"org.apache.spark:spark-hadoop-cloud_{SCALA_VERSION}:{SPARK_VERSION}"
+
+# IAMInstanceCredentialsProvider only exists from Hadoop 3.3. The AWS SDK class works on older releases and is
+# mapped to it by Hadoop 3.4+, so it is used whenever the Hadoop version is unknown
+if HADOOP_VERSION and tuple(int(i) for i in HADOOP_VERSION.split(".")[:2]) >= (3, 3):
+    INSTANCE_CREDENTIALS_PROVIDER = "org.apache.hadoop.fs.s3a.auth.IAMInstanceCredentialsProvider"
+else:
+    INSTANCE_CREDENTIALS_PROVIDER = "com.amazonaws.auth.InstanceProfileCredentialsProvider"
+
+# Credentials come from AWS_* environment variables for local runs, falling back to the EC2 instance profile.
+# hadoop-aws matches the bundled Hadoop client and brings in the AWS SDK bundle it was built against.
+# The S3A magic committer writes parquet output in place rather than renaming (copying) every file on commit.
+# Adaptive query execution sizes shuffle partitions and join strategies from runtime statistics.
+# Kryo replaces Java serialization for shuffled and cached RDD data, and Arrow handles Python <-> JVM transfers.
 spark = SparkSession.builder\
-                    .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:3.2.2,com.amazonaws:aws-java-sdk:1.12.369")\
-                    .config('spark.hadoop.fs.s3a.aws.credentials.provider', 'org.apache.hadoop.fs.s3a.SimpleAWSCredentialsProvider') \
+                    .config("spark.jars.packages", JARS_PACKAGES)\
+                    .config('spark.hadoop.fs.s3a.aws.credentials.provider',
+                            f'com.amazonaws.auth.EnvironmentVariableCredentialsProvider,{INSTANCE_CREDENTIALS_PROVIDER}')\
+                    .config("spark.hadoop.fs.s3a.committer.name", "magic")\
+                    .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true")\
+                    .config("spark.sql.sources.commitProtocolClass", "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol")\
+                    .config("spark.sql.parquet.output.committer.class", "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter")\
+                    .config("spark.sql.adaptive.enabled", "true")\
+                    .config("spark.sql.adaptive.coalescePartitions.enabled", "true")\
+                    .config("spark.sql.adaptive.skewJoin.enabled", "true")\
+                    .config("spark.sql.adaptive.localShuffleReader.enabled", "true")\
+                    .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m")\
+                    .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer")\
+                    .config("spark.kryo.registrationRequired", "false")\
+                    .config("spark.sql.execution.arrow.pyspark.enabled", "true")\
                     .enableHiveSupport()\
                     .getOrCreate()
 
+# Matches the body of each SAS label section used to decode I-94 codes, up to its closing semicolon
+SAS_LABELS_PATTERN = re.compile(r"value\s+\$?(i94cntyl|i94model|i94addrl)\b(.*?);", re.DOTALL)
+
+# I-94 fields referenced downstream; selecting them at load time prunes the remaining parquet columns from the scan,
+# including the mostly incomplete occup, entdepu and insnum fields
+IMMIGRATION_COLUMNS = ["cicid", "i94yr", "i94mon", "i94cit", "i94res", "i94mode", "i94bir", "i94visa", "arrdate",
+                       "depdate", "i94port", "i94addr", "dtadfile", "dtaddto", "visapost", "entdepa", "entdepd",
+                       "matflag", "biryear", "admnum", "fltno", "airline"]
+
+# CSV schemas are positional, so every column in the source files is declared
+TEMPERATURE_SCHEMA = StructType([
+    StructField("dt", StringType()),
+    StructField("AverageTemperature", DoubleType()),
+    StructField("AverageTemperatureUncertainty", DoubleType()),
+    StructField("City", StringType()),
+    StructField("Country", StringType()),
+    StructField("Latitude", StringType()),
+    StructField("Longitude", StringType())
+])
+
+DEMOGRAPHICS_SCHEMA = StructType([
+    StructField("City", StringType()),
+    StructField("State", StringType()),
+    StructField("Median Age", DoubleType()),
+    StructField("Male Population", IntegerType()),
+    StructField("Female Population", IntegerType()),
+    StructField("Total Population", IntegerType()),
+    StructField("Number of Veterans", IntegerType()),
+    StructField("Foreign-born", IntegerType()),
+    StructField("Average Household Size", DoubleType()),
+    StructField("State Code", StringType()),
+    StructField("Race", StringType()),
+    StructField("Count", IntegerType())
+])
+
+AIRPORT_SCHEMA = StructType([
+    StructField("ident", StringType()),
+    StructField("type", StringType()),
+    StructField("name", StringType()),
+    StructField("elevation_ft", IntegerType()),
+    StructField("continent", StringType()),
+    StructField("iso_country", StringType()),
+    StructField("iso_region", StringType()),
+    StructField("municipality", StringType()),
+    StructField("gps_code", StringType()),
+    StructField("iata_code", StringType()),
+    StructField("local_code", StringType()),
+    StructField("coordinates", StringType())
+])
+
+
+def staged_copy_is_current(csv_fp, parquet_fp):
+    """
+    Checks whether a staged parquet copy was fully written and is newer than its source CSV
+    :param csv_fp: filepath which contains the source CSV data
+    :param parquet_fp: filepath which contains the staged parquet data
+    :return: True if the parquet copy has a _SUCCESS marker written after the CSV was last modified
+    """
+
+    jvm_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path
+    hadoop_conf = spark.sparkContext._jsc.hadoopConfiguration()
+
+    success_path = jvm_path(jvm_path(parquet_fp), "_SUCCESS")
+    parquet_fs = success_path.getFileSystem(hadoop_conf)
+    if not parquet_fs.exists(success_path):
+        return False
+
+    csv_path = jvm_path(csv_fp)
+    csv_modified = csv_path.getFileSystem(hadoop_conf).getFileStatus(csv_path).getModificationTime()
+    return parquet_fs.getFileStatus(success_path).getModificationTime() >= csv_modified
+
+
+def bootstrap_parquet(temperature_csv_fp, airport_csv_fp, temperature_fp, airport_fp):
+    """
+    Converts the temperature and airport CSV sources to parquet so that subsequent runs can read them with
+    column pruning and predicate pushdown. A staged copy is only rewritten when it is missing its _SUCCESS marker
+    (e.g. after a failed conversion) or its source CSV has changed since it was written.
+    :param temperature_csv_fp: filepath which contains the temperature CSV data
+    :param airport_csv_fp: filepath which contains the airport codes CSV data
+    :param temperature_fp: filepath to write the temperature parquet data to
+    :param airport_fp: filepath to write the airport codes parquet data to
+    """
+
+    if not staged_copy_is_current(temperature_csv_fp, temperature_fp):
+        print('Converting temperature CSV to parquet...')
+        spark.read.schema(TEMPERATURE_SCHEMA).csv(temperature_csv_fp, header=True) \
+            .write.parquet(temperature_fp, partitionBy='Country', mode="overwrite", compression="snappy")
+
+    if not staged_copy_is_current(airport_csv_fp, airport_fp):
+        print('Converting airport codes CSV to parquet...')
+        spark.read.schema(AIRPORT_SCHEMA).csv(airport_csv_fp, header=True) \
+            .write.parquet(airport_fp, mode="overwrite", compression="snappy")
+
 
 def load_dataframes(immigration_fp, temperature_fp, demographics_fp, airport_fp):
     """
     Loads files into respective Spark dataframes for staging
     :param immigration_fp: filepath which contains the immigration parquet data
-    :param temperature_fp: filepath which contains the temperature CSV data
+    :param temperature_fp: filepath which contains the temperature parquet data
     :param demographics_fp: filepath which contains the demographics CSV data
-    :param airport_fp: filepath which contains the US airports CSV data
+    :param airport_fp: filepath which contains the airport codes parquet data
     :return: all respective Spark dataframes
     """
 
     immigration_file = immigration_fp
-    df_immigration = spark.read.parquet(immigration_file)
+    df_immigration = spark.read.parquet(immigration_file).select(*IMMIGRATION_COLUMNS)
 
     temperature_file = temperature_fp
-    df_temperature = spark.read.csv(temperature_file, header=True, inferSchema=True)
+    df_temperature = spark.read.parquet(temperature_file)
 
     demographics_file = demographics_fp
-    df_demographics = spark.read.csv(demographics_file, inferSchema=True, header=True, sep=';')
+    df_demographics = spark.read.schema(DEMOGRAPHICS_SCHEMA).csv(demographics_file, header=True, sep=';')
 
     airport_file = airport_fp
-    df_airport_codes = spark.read.csv(airport_file, header=True, inferSchema=True)
-    df_airport_codes = df_airport_codes.filter(df_airport_codes.iso_country == 'US')
+    df_airport_codes = spark.read.parquet(airport_file) \
+        .filter(col("iso_country") == 'US') \
+        .select("iata_code", "type", "name", "continent", "iso_country", "iso_region", "municipality")
 
     return df_immigration, df_temperature, df_demographics, df_airport_codes
 
@@ -59,30 +217,23 @@ def fetch_sas_key_values(labels_fp, df_immigration):
         f_content = f.read()
         f_content = f_content.replace('\t', '')
 
-    def code_mapper(file, idx):
-        f_content2 = f_content[f_content.index(idx):]
-        f_content2 = f_content2[:f_content2.index(';')].split('\n')
-        f_content2 = [i.replace("'", "") for i in f_content2]
-        dic = [i.split('=') for i in f_content2[1:]]
-        dic = dict([i[0].strip(), i[1].strip()] for i in dic if len(i) == 2)
-        return dic
-
-    i94cit_res = code_mapper(f_content, "i94cntyl")
-    i94mode = code_mapper(f_content, "i94model")
-    i94addr = code_mapper(f_content, "i94addrl")
+    # Parsing every label section in a single pass over the file
+    labels = {}
+    for match in SAS_LABELS_PATTERN.finditer(f_content):
+        lines = [i.replace("'", "") for i in match.group(2).split('\n')[1:]]
+        pairs = [i.split('=') for i in lines]
+        labels[match.group(1)] = dict([i[0].strip(), i[1].strip()] for i in pairs if len(i) == 2)
+
+    i94cit_res = labels["i94cntyl"]
+    i94mode = labels["i94model"]
+    i94addr = labels["i94addrl"]
     i94visa = {'1': 'Business',
                '2': 'Pleasure',
                '3': 'Student'}
 
     # Converting id fields to integers for value mapping
-    df_immigration = df_immigration.withColumn("cicid", df_immigration.cicid.cast("int")) \
-        .withColumn("i94yr", df_immigration.i94yr.cast("int")) \
-        .withColumn("i94mon", df_immigration.i94mon.cast("int")) \
-        .withColumn("i94cit", df_immigration.i94cit.cast("int")) \
-        .withColumn("i94res", df_immigration.i94res.cast("int")) \
-        .withColumn("i94mode", df_immigration.i94mode.cast("int")) \
-        .withColumn("i94bir", df_immigration.i94bir.cast("int")) \
-        .withColumn("i94visa", df_immigration.i94visa.cast("int"))
+    int_cols = ["cicid", "i94yr", "i94mon", "i94cit", "i94res", "i94mode", "i94bir", "i94visa"]
+    int_exprs = {c: col(c).cast("int") for c in int_cols}
 
     # Creating map literals to create value columns based on key mappings
     mapping_i94cit_res = create_map([lit(x) for x in chain(*i94cit_res.items())])
@@ -90,12 +241,15 @@ def fetch_sas_key_values(labels_fp, df_immigration):
     mapping_i94addr = create_map([lit(x) for x in chain(*i94addr.items())])
     mapping_i94visa = create_map([lit(x) for x in chain(*i94visa.items())])
 
-    # Adding columns to dataframe based on I-94 codes and their mappings
-    df_immigration = df_immigration.withColumn("i94cit_value", mapping_i94cit_res.getItem(col("i94cit"))) \
-        .withColumn("i94res_value", mapping_i94cit_res.getItem(col("i94res"))) \
-        .withColumn("i94mode_value", mapping_i94mode.getItem(col("i94mode"))) \
-        .withColumn("i94addr_value", mapping_i94addr.getItem(col("i94addr"))) \
-        .withColumn("i94visa_value", mapping_i94visa.getItem(col("i94visa")))
+    # Casting id fields and adding value columns based on I-94 codes in a single projection
+    df_immigration = df_immigration.select(
+        *[int_exprs[c].alias(c) if c in int_exprs else col(c) for c in df_immigration.columns],
+        mapping_i94cit_res[int_exprs["i94cit"]].alias("i94cit_value"),
+        mapping_i94cit_res[int_exprs["i94res"]].alias("i94res_value"),
+        mapping_i94mode[int_exprs["i94mode"]].alias("i94mode_value"),
+        mapping_i94addr[col("i94addr")].alias("i94addr_value"),
+        mapping_i94visa[int_exprs["i94visa"]].alias("i94visa_value")
+    )
 
     return df_immigration
 
@@ -105,26 +259,21 @@ def clean_immigration_data(df_immigration):
     Inputs: I-94 immigration Spark dataframe
 
     This function takes in the preloaded immigration dataframe and performs a few data cleaning tasks...
-    1. Drops incomplete fields
-    2. Drops any rows with duplicate `cicid` values
-    3. Converts SAS dates to datetype
-    """
+    1. Converts SAS dates to datetype
+    2. Drops any rows with missing or duplicate `cicid` values
 
-    print('Cleaning (1/3): Converting SAS dates to date type...')
-    # Create UDF to convert SAS dates to date type
-    get_date = udf(lambda x: (dt.datetime(1960, 1, 1).date() + dt.timedelta(x)).isoformat() if x else None)
-    df_immigration = df_immigration.withColumn("arrdate", get_date(df_immigration.arrdate)) \
-        .withColumn("depdate", get_date(df_immigration.depdate))
+    Fields with mostly incomplete data (occup, entdepu, insnum) are already excluded by IMMIGRATION_COLUMNS at load time.
+    """
 
-    print('Cleaning (2/3): Dropping fields with mostly incomplete data...')
-    # Dropping fields with mostly incomplete data
-    drop_cols = ['occup', 'entdepu', 'insnum']
-    df_immigration = df_immigration.drop(*drop_cols)
+    print('Cleaning (1/2): Converting SAS dates to date type...')
+    # SAS dates are stored as days since 1960-01-01
+    sas_epoch = lit("1960-01-01").cast("date")
+    df_immigration = df_immigration.withColumn("arrdate", date_add(sas_epoch, df_immigration.arrdate.cast("int"))) \
+        .withColumn("depdate", date_add(sas_epoch, df_immigration.depdate.cast("int")))
 
-    print('Cleaning (3/3): Dropping fields with mostly incomplete data...')
-    # Dropping rows with duplicate cicid values
-    df_immigration = df_immigration.dropDuplicates(['cicid'])
-    cleaned_df_immigration = df_immigration.dropna(how='all', subset=['cicid'])
+    print('Cleaning (2/2): Dropping rows with missing or duplicate cicid values...')
+    # Filtering null cicid values first so the dedup shuffle only carries valid rows
+    cleaned_df_immigration = df_immigration.filter(col('cicid').isNotNull()).dropDuplicates(['cicid'])
 
     print('Cleaning: Done!')
 
@@ -135,62 +284,66 @@ def clean_temperature_data(df_temperature):
     """
     Inputs: Country temperatures Spark dataframe
 
-    This function takes in the preloaded temperatures dataframe and drops (a) duplicate rows,
-    and (b) rows with missing average temperatures.
+    This function takes in the preloaded temperatures dataframe and drops (a) rows with missing average
+    temperatures, and (b) duplicate readings for the same date and city, where a city is identified by its name,
+    country and coordinates.
     """
-    df_temperature = df_temperature.dropDuplicates()
-    cleaned_df_temperature = df_temperature.na.drop(subset=["AverageTemperature"])
+    df_temperature = df_temperature.na.drop(subset=["AverageTemperature"])
+    cleaned_df_temperature = df_temperature.dropDuplicates(["dt", "City", "Country", "Latitude", "Longitude"])
 
     print('Done!')
     return cleaned_df_temperature
 
 
-def process_tables(df_temperature, df_airport_codes, df_demographics, df_immigration, output_path):
+def process_tables(df_temperature, df_airport_codes, df_demographics, df_immigration, output_path,
+                   dim_join_hint="BROADCAST"):
+
+    if dim_join_hint not in DIM_JOIN_HINTS:
+        raise ValueError(f"dim_join_hint must be one of {sorted(DIM_JOIN_HINTS)}, got {dim_join_hint!r}")
 
     df_immigration.createOrReplaceTempView("df_immigration")
+    # Deduplicating the single arrdate column before deriving the calendar fields keeps the shuffle to distinct dates
     calendar_dim = spark.sql("""
-                                select distinct
-                                    arrdate as date,
-                                    year(arrdate) as year,
-                                    month(arrdate) as month,
-                                    weekofyear(arrdate) as week,
-                                    dayofyear(arrdate) as day,
-                                    dayofweek(arrdate) as weekday
-                                from df_immigration
+                                select
+                                    date,
+                                    year(date) as year,
+                                    month(date) as month,
+                                    weekofyear(date) as week,
+                                    dayofyear(date) as day,
+                                    dayofweek(date) as weekday
+                                from (select distinct arrdate as date from df_immigration)
                                 """)
 
-    df_country = df_temperature.select(col("Country")).distinct()
     df_temperature.createOrReplaceTempView("df_temperature")
-    df_country.createOrReplaceTempView("df_country")
     country_dim = spark.sql("""
                                 select
-                                    row_number() over (ORDER BY "c.Country") as country_id,
-                                    c.Country as country_name,
-                                    min(t.AverageTemperature) as country_avg_temp_min,
-                                    max(t.AverageTemperature) as country_avg_temp_max
-                                from df_country c
-                                left join df_temperature t on c.Country = t.Country
-                                group by c.Country
-
+                                    row_number() over (order by Country) as country_id,
+                                    Country as country_name,
+                                    lower(Country) as country_name_lc,
+                                    min(AverageTemperature) as country_avg_temp_min,
+                                    max(AverageTemperature) as country_avg_temp_max
+                                from df_temperature
+                                group by Country
                                 """)
 
+    continents = {'NA': 'North America',
+                  'AF': 'Africa',
+                  'AN': 'Antarctica',
+                  'AS': 'Asia',
+                  'EU': 'Europe',
+                  'OC': 'Oceania',
+                  'SA': 'South America'}
+    mapping_continent = create_map([lit(x) for x in chain(*continents.items())])
+    df_airport_codes = df_airport_codes.withColumn("continent_name", mapping_continent[col("continent")])
     df_airport_codes.createOrReplaceTempView("df_airport_codes")
     us_airport_dim = spark.sql("""
                                 select
-                                    row_number() over (order by "iata_code") as airport_id,
+                                    row_number() over (order by iata_code) as airport_id,
                                     iata_code as airport_code,
                                     type as airport_type,
                                     name as airport_name,
                                     continent as continent_code,
-                                    case 
-                                        when continent = 'NA' then 'North America'
-                                        when continent = 'AF' then 'Africa'
-                                        when continent = 'AN' then 'Antarctica'
-                                        when continent = 'AS' then 'Asia'
-                                        when continent = 'EU' then 'Europe'
-                                        when continent = 'OC' then 'Oceania'
-                                        when continent = 'SA' then 'South America'
-                                    end as continent_name,
+                                    continent_name,
                                     iso_country as country_code,
                                     right(iso_region,2) as state_code,
                                     municipality
@@ -218,9 +371,12 @@ def process_tables(df_temperature, df_airport_codes, df_demographics, df_immigra
     us_airport_dim.createOrReplaceTempView("us_airport_dim")
     us_demographics_dim.createOrReplaceTempView("us_demographics_dim")
     country_dim.createOrReplaceTempView("country_dim")
-    df_immigration.createOrReplaceTempView("df_immigration")
-    immigration_fact = spark.sql("""
-                                select 
+    # Lower-casing the country join key once per row rather than inside the join condition
+    df_immigration.withColumn("i94cit_value_lc", lower(col("i94cit_value"))).createOrReplaceTempView("df_immigration")
+    # Dimensions are broadcast by default; set DIM_JOIN_HINT=SHUFFLE_HASH in config.cfg once they outgrow executor
+    # memory so the fact table is hashed against them instead of being sorted for a sort-merge join
+    immigration_fact = spark.sql(f"""
+                                select /*+ {dim_join_hint}(birth, res, p, d) */
                                     birth.country_id as birth_country_id,
                                     res.country_id as res_country_id,
                                     p.airport_id,
@@ -243,28 +399,32 @@ def process_tables(df_temperature, df_airport_codes, df_demographics, df_immigra
                                     fltno as flight_num,
                                     airline airline_code
                                 from df_immigration i
-                                left join country_dim birth on lower(i.i94cit_value)=lower(birth.country_name)
-                                left join country_dim res on lower(i.i94cit_value)=lower(res.country_name)
+                                left join country_dim birth on i.i94cit_value_lc = birth.country_name_lc
+                                left join country_dim res on i.i94cit_value_lc = res.country_name_lc
                                 left join us_airport_dim p on i.i94port = p.airport_code
                                 left join us_demographics_dim d on i.i94addr = d.state_code
                                 """)
 
-    immigration_fact = immigration_fact.withColumn("record_id", monotonically_increasing_id())
+    immigration_fact = immigration_fact.withColumn("record_id", monotonically_increasing_id()) \
+        .withColumn("arr_year", year("arrival_date")) \
+        .withColumn("arr_month", month("arrival_date"))
 
+    # Dimensions are small enough for a single file each. The fact table is rebalanced on its partition columns so
+    # AQE splits each month into advisory-sized tasks instead of funnelling a whole month through one writer
     print('(1/5) Creating calendar_dim...')
-    calendar_dim.write.parquet(output_path + "calendar_dim", partitionBy=['year', 'month', 'week'], mode="overwrite")
+    calendar_dim.coalesce(1).write.parquet(output_path + "calendar_dim", partitionBy=['year', 'month', 'week'], mode="overwrite")
 
     print('(2/5) Creating us_demographics_dim...')
-    us_demographics_dim.write.parquet(output_path + "us_demographics_dim", partitionBy='state_code', mode="overwrite")
+    us_demographics_dim.coalesce(1).write.parquet(output_path + "us_demographics_dim", partitionBy='state_code', mode="overwrite")
 
     print('(3/5) Creating us_airport_dim...')
-    us_airport_dim.write.parquet(output_path + "us_airport_dim", mode="overwrite")
+    us_airport_dim.coalesce(1).write.parquet(output_path + "us_airport_dim", mode="overwrite")
 
     print('(4/5) Creating country_dim...')
-    country_dim.write.parquet(output_path + "country_dim", mode="overwrite")
+    country_dim.drop("country_name_lc").coalesce(1).write.parquet(output_path + "country_dim", mode="overwrite")
 
     print('(5/5) Creating immigration_fact...')
-    immigration_fact.write.parquet(output_path + "immigration_fact", mode="overwrite")
+    immigration_fact.hint("rebalance", "arr_year", "arr_month").write.parquet(output_path + "immigration_fact", partitionBy=['arr_year', 'arr_month'], mode="overwrite")
 
     print('Done!')
 
@@ -273,17 +433,27 @@ def main():
 
     labels_fp = "./I94_SAS_Labels_Descriptions.SAS"
     immigration_fp = os.path.join(SOURCE_S3_BUCKET + "sas_data/*.parquet")
-    temperature_fp = os.path.join(SOURCE_S3_BUCKET + "temperature_data/GlobalLandTemperaturesByCity.csv")
+    temperature_csv_fp = os.path.join(SOURCE_S3_BUCKET + "temperature_data/GlobalLandTemperaturesByCity.csv")
     demographics_fp = os.path.join(SOURCE_S3_BUCKET + "us-cities-demographics.csv")
-    airport_fp = os.path.join(SOURCE_S3_BUCKET + "airport-codes_csv.csv")
+    airport_csv_fp = os.path.join(SOURCE_S3_BUCKET + "airport-codes_csv.csv")
+    temperature_fp = os.path.join(STAGING_S3_BUCKET + "temperature")
+    airport_fp = os.path.join(STAGING_S3_BUCKET + "airport_codes")
     output_path = DEST_S3_BUCKET
 
+    bootstrap_parquet(temperature_csv_fp, airport_csv_fp, temperature_fp, airport_fp)
     df_immigration, df_temperature, df_demographics, df_airport_codes = load_dataframes(immigration_fp, temperature_fp,
                                                                                         demographics_fp, airport_fp)
     df_immigration = fetch_sas_key_values(labels_fp, df_immigration)
     df_immigration = clean_immigration_data(df_immigration)
     df_temperature = clean_temperature_data(df_temperature)
-    process_tables(df_temperature, df_airport_codes, df_demographics, df_immigration, output_path)
+
+    # Both calendar_dim and immigration_fact read df_immigration, so materialize it once
+    df_immigration = df_immigration.persist(StorageLevel.MEMORY_AND_DISK)
+    df_immigration.count()
+
+    process_tables(df_temperature, df_airport_codes, df_demographics, df_immigration, output_path,
+                   dim_join_hint=DIM_JOIN_HINT)
+    df_immigration.unpersist()
 
 
 if __name__ == "__main__":